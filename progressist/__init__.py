@@ -1,8 +1,25 @@
+import array
+import collections
+import concurrent.futures
 import datetime
+import gzip
+import http.client
+import io
+import itertools
+import json
+import mmap
+import operator
+import os
+import queue
 import shutil
+import stat
 import string
+import struct
 import sys
+import threading
 import time
+import traceback
+import urllib.parse
 
 try:
     import pkg_resources
@@ -44,6 +61,468 @@ class Formatter(string.Formatter):
         return super().format_field(value, format_string)
 
 
+class Profiler:
+    """
+    Record throughput samples and stalls of a ProgressBar.
+
+    Throughput is kept in fixed size arrays used as a ring buffer, so memory
+    does not grow with the duration of the job. A watchdog thread captures
+    the stack of the updating thread when no progress has been made for
+    `stall` seconds.
+    """
+
+    def __init__(self, interval=1, stall=5, size=1024):
+        self.interval = interval
+        self.stall = stall
+        self.size = size
+        self.stamps = array.array('d', [0.0]) * size
+        self.rates = array.array('d', [0.0]) * size
+        self.count = 0
+        self.stalls = []
+        self.stalled = None
+        self.thread = None
+        self.watchdog = None
+        self.stopped = False
+        self._stop = threading.Event()
+
+    def start(self, done):
+        self.thread = threading.get_ident()
+        self.last = self.bucket_start = time.time()
+        self.done = self.bucket_done = done
+        self.watchdog = threading.Thread(target=self.watch, daemon=True)
+        self.watchdog.start()
+
+    def tick(self, done):
+        if self.watchdog is None:
+            self.start(done)
+            return
+        now = time.time()
+        if self.stalled is not None:
+            self.stalled['end'] = now
+            self.stalled = None
+        self.last = now
+        self.done = done
+        if now - self.bucket_start >= self.interval:
+            self.push(now)
+
+    def push(self, now):
+        idx = self.count % self.size
+        self.stamps[idx] = self.bucket_start
+        self.rates[idx] = (self.done - self.bucket_done) / (
+            now - self.bucket_start)
+        self.count += 1
+        self.bucket_start = now
+        self.bucket_done = self.done
+
+    def watch(self):
+        while not self._stop.wait(self.stall / 2):
+            if (self.stalled is None
+               and time.time() - self.last >= self.stall):
+                frame = sys._current_frames().get(self.thread)
+                stack = traceback.format_stack(frame) if frame else []
+                self.stalled = {'start': self.last, 'end': None,
+                                'done': self.done, 'stack': stack}
+                self.stalls.append(self.stalled)
+
+    def stop(self):
+        self.stopped = True
+        if self.watchdog is None:
+            return
+        self._stop.set()
+        self.watchdog.join()
+        now = time.time()
+        if self.stalled is not None:
+            self.stalled['end'] = now
+            self.stalled = None
+        if now > self.bucket_start and self.done > self.bucket_done:
+            self.push(now)
+
+    @property
+    def samples(self):
+        """(timestamp, rate) pairs, oldest first."""
+        first = max(0, self.count - self.size)
+        for i in range(first, self.count):
+            idx = i % self.size
+            yield self.stamps[idx], self.rates[idx]
+
+    def report(self):
+        rates = [rate for _, rate in self.samples]
+        lines = ['Throughput: {} samples'.format(len(rates))]
+        if rates:
+            lines[0] += ', min {:.2f}/s, avg {:.2f}/s, max {:.2f}/s'.format(
+                min(rates), sum(rates) / len(rates), max(rates))
+        lines.append('Stalls: {}'.format(len(self.stalls)))
+        for stall in self.stalls:
+            lines.append('  {:.2f}s without progress at {}:'.format(
+                stall['end'] - stall['start'], stall['done']))
+            lines.extend('  ' + line.rstrip()
+                         for line in ''.join(stall['stack']).splitlines())
+        return '\n'.join(lines) + '\n'
+
+    def trace_events(self):
+        """Events in Chrome trace-event format (timestamps in µs)."""
+        pid = os.getpid()
+        events = []
+        for stamp, rate in self.samples:
+            events.append({'name': 'throughput', 'ph': 'C', 'pid': pid,
+                           'tid': self.thread, 'ts': stamp * 1e6,
+                           'args': {'rate': rate}})
+        for stall in self.stalls:
+            events.append({'name': 'stall', 'ph': 'X', 'pid': pid,
+                           'tid': self.thread, 'ts': stall['start'] * 1e6,
+                           'dur': (stall['end'] - stall['start']) * 1e6,
+                           'args': {'done': stall['done'],
+                                    'stack': ''.join(stall['stack'])}})
+        return events
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.trace_events()}, f)
+
+
+class Quantile:
+    """
+    Streaming quantile estimation with the P² algorithm.
+
+    Only five markers are kept, whatever the number of observations, and each
+    observation is added in constant time.
+    """
+
+    def __init__(self, p):
+        self.p = p
+        self.heights = []
+        self.positions = [0, 1, 2, 3, 4]
+        self.desired = [0, 2 * p, 4 * p, 2 + 2 * p, 4]
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, x):
+        q = self.heights
+        if len(q) < 5:
+            q.append(x)
+            q.sort()
+            return
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+        n = self.positions
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            if ((d >= 1 and n[i + 1] - n[i] > 1)
+               or (d <= -1 and n[i - 1] - n[i] < -1)):
+                d = 1 if d > 0 else -1
+                height = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (q[i + 1] - q[i])
+                    / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1])
+                    / (n[i] - n[i - 1]))
+                if not q[i - 1] < height < q[i + 1]:
+                    # Parabolic prediction out of bounds, go linear.
+                    height = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = height
+                n[i] += d
+
+    @property
+    def value(self):
+        if not self.heights:
+            return 0
+        if len(self.heights) < 5:
+            idx = round(self.p * (len(self.heights) - 1))
+            return self.heights[idx]
+        return self.heights[2]
+
+
+class RateHistory:
+    """Ring buffer of the rates of the last `size` intervals."""
+
+    blocks = '▁▂▃▄▅▆▇█'
+
+    def __init__(self, size=10, interval=1):
+        self.size = size
+        self.interval = interval
+        self.rates = array.array('d', [0.0]) * size
+        self.count = 0
+        self.bucket_start = None
+        self.bucket_done = 0
+
+    def add(self, now, done):
+        if self.bucket_start is None:
+            self.bucket_start = now
+            self.bucket_done = done
+        elif now - self.bucket_start >= self.interval:
+            self.rates[self.count % self.size] = (
+                (done - self.bucket_done) / (now - self.bucket_start))
+            self.count += 1
+            self.bucket_start = now
+            self.bucket_done = done
+
+    def __iter__(self):
+        for i in range(max(0, self.count - self.size), self.count):
+            yield self.rates[i % self.size]
+
+    def render(self):
+        rates = list(self)
+        if not rates:
+            return ''
+        top = max(rates) or 1
+        last = len(self.blocks) - 1
+        return ''.join(self.blocks[max(0, min(last, int(rate / top * last)))]
+                       for rate in rates)
+
+
+class Stage:
+    """
+    Wrap one stage iterator of a Pipeline.
+
+    Items are counted in a local variable, published to `count` once every
+    `sample` items (along with timing that call) and at the end, to keep
+    the overhead low on fast pipelines.
+    """
+
+    def __init__(self, name, iterable, upstream=None, sample=64):
+        self.name = name
+        self.upstream = upstream
+        self.sample = sample
+        self.count = 0
+        self.sampled = 0
+        self.timed = 0.0
+        self.iterator = self.run(iter(iterable))
+
+    def __iter__(self):
+        return self.iterator
+
+    def __next__(self):
+        return next(self.iterator)
+
+    def run(self, iterator):
+        count = 0
+        end = object()
+        try:
+            while True:
+                start = time.perf_counter()
+                item = next(iterator, end)
+                if item is end:
+                    return
+                self.timed += time.perf_counter() - start
+                self.sampled += 1
+                count += 1
+                self.count = count
+                yield item
+                for item in itertools.islice(iterator, self.sample - 1):
+                    count += 1
+                    yield item
+        finally:
+            self.count = count
+
+    @property
+    def received(self):
+        """Number of items pulled from the upstream stage, if any."""
+        return self.upstream.count if self.upstream else self.count
+
+    @property
+    def elapsed(self):
+        """Estimated time spent in this stage and its upstream stages."""
+        if not self.sampled:
+            return 0
+        return self.timed / self.sampled * self.count
+
+    @property
+    def own(self):
+        """Estimated time spent in this stage only."""
+        upstream = self.upstream.elapsed if self.upstream else 0
+        return max(0, self.elapsed - upstream)
+
+
+class Pipeline:
+    """
+    Per stage metrics of chained iterators.
+
+    Register each stage with `stage`, in order, then use the pipeline as a
+    template var to render the items in/out and the share of time of each
+    stage, the bottleneck being marked with a star:
+
+        pipeline = Pipeline()
+        lines = pipeline.stage('read', open(path))
+        records = pipeline.stage('parse', map(parse, lines))
+        bar = ProgressBar(template='{done} {pipeline}', pipeline=pipeline)
+        for record in bar.iter(records):
+            ...
+    """
+
+    def __init__(self):
+        self.stages = []
+
+    def stage(self, name, iterable, sample=64):
+        upstream = self.stages[-1] if self.stages else None
+        stage = Stage(name, iterable, upstream=upstream, sample=sample)
+        self.stages.append(stage)
+        return stage
+
+    @property
+    def bottleneck(self):
+        if not self.stages:
+            return None
+        return max(self.stages, key=lambda stage: stage.own)
+
+    def __format__(self, format_spec):
+        total = sum(stage.own for stage in self.stages)
+        bottleneck = self.bottleneck if total else None
+        parts = []
+        for stage in self.stages:
+            share = stage.own / total if total else 0
+            parts.append('{}{} {}→{} {:.0%}'.format(
+                '*' if stage is bottleneck else '', stage.name,
+                stage.received, stage.count, share))
+        return format(' | '.join(parts), format_spec)
+
+
+Frame = collections.namedtuple('Frame', ['timestamp', 'done', 'total',
+                                         'line'])
+
+
+class Recorder:
+    """
+    Record rendered frames into a compact binary log.
+
+    The log starts with a magic string, then each frame is stored as its
+    timestamp, done and total values, followed by the length prefixed
+    rendered line encoded in utf-8.
+    """
+
+    MAGIC = b'PGR1'
+    HEADER = struct.Struct('<dddI')
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(self.MAGIC)
+
+    def add(self, timestamp, done, total, line):
+        data = line.encode()
+        self.file.write(self.HEADER.pack(timestamp, done, total, len(data)))
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+
+def read_frames(path):
+    """Iterate over the frames recorded in the log at path."""
+    with open(path, 'rb') as f:
+        if f.read(len(Recorder.MAGIC)) != Recorder.MAGIC:
+            raise ValueError('Not a progressist log: {}'.format(path))
+        size = Recorder.HEADER.size
+        while True:
+            header = f.read(size)
+            if len(header) < size:
+                return
+            timestamp, done, total, length = Recorder.HEADER.unpack(header)
+            # Values are stored as doubles, restore integers.
+            if done.is_integer():
+                done = int(done)
+            if total.is_integer():
+                total = int(total)
+            yield Frame(timestamp, done, total, f.read(length).decode())
+
+
+def replay(path, **kwargs):
+    """Render again the frames recorded in the log at path.
+
+    Any ProgressBar parameter (eg. `template`) can be passed, the bar is
+    headless and its clock is driven by the recorded timestamps. Only the
+    frames actually rendered (eg. not throttled) are yielded.
+    """
+    now = None
+    kwargs.setdefault('headless', True)
+    bar = ProgressBar(clock=lambda: now, **kwargs)
+    for frame in read_frames(path):
+        now = frame.timestamp
+        if bar.start is None:
+            bar.start = now
+        bar.done = frame.done
+        bar.total = frame.total
+        if bar.measured:
+            bar.measure()
+        prints = bar.prints
+        bar.render()
+        if bar.prints != prints:
+            yield bar.frame
+
+
+Status = collections.namedtuple('Status', ['done', 'total', 'start',
+                                           'updated', 'rate'])
+
+
+class StatusFile:
+    """
+    Publish the state of a bar into a fixed layout memory-mapped file.
+
+    The layout is a magic string, a version, a sequence counter, then the
+    fields of `Status` as doubles. The counter is odd while the fields are
+    being written, so readers can retry until they get a consistent
+    snapshot (seqlock). Publishing only writes to memory.
+    """
+
+    MAGIC = b'PGST'
+    VERSION = 1
+    HEADER = struct.Struct('<4sI')
+    SEQ = struct.Struct('<Q')
+    FIELDS = struct.Struct('<5d')
+    SEQ_OFFSET = HEADER.size
+    FIELDS_OFFSET = SEQ_OFFSET + SEQ.size
+    SIZE = FIELDS_OFFSET + FIELDS.size
+
+    def __init__(self, path):
+        with open(path, 'wb') as f:
+            f.write(bytes(self.SIZE))
+        with open(path, 'r+b') as f:
+            self.map = mmap.mmap(f.fileno(), self.SIZE)
+        self.HEADER.pack_into(self.map, 0, self.MAGIC, self.VERSION)
+        self.seq = 0
+
+    def publish(self, done, total, start, updated, rate):
+        self.SEQ.pack_into(self.map, self.SEQ_OFFSET, self.seq + 1)
+        self.FIELDS.pack_into(self.map, self.FIELDS_OFFSET, done, total,
+                              start, updated, rate)
+        self.seq += 2
+        self.SEQ.pack_into(self.map, self.SEQ_OFFSET, self.seq)
+
+    def close(self):
+        self.map.close()
+
+
+def read_status(path, retries=1000):
+    """Read a consistent snapshot of the status file at path."""
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), StatusFile.SIZE, access=mmap.ACCESS_READ)
+    with data:
+        magic, version = StatusFile.HEADER.unpack_from(data, 0)
+        if magic != StatusFile.MAGIC or version != StatusFile.VERSION:
+            raise ValueError('Not a progressist status file: {}'.format(path))
+        for _ in range(retries):
+            before, = StatusFile.SEQ.unpack_from(data, StatusFile.SEQ_OFFSET)
+            if not before % 2:
+                fields = StatusFile.FIELDS.unpack_from(
+                    data, StatusFile.FIELDS_OFFSET)
+                after, = StatusFile.SEQ.unpack_from(data,
+                                                    StatusFile.SEQ_OFFSET)
+                if before == after:
+                    return Status(*fields)
+            # Let the writer finish its update.
+            time.sleep(0)
+    raise RuntimeError('Could not read a consistent status from {}'.format(
+        path))
+
+
 class ProgressBar:
 
     prefix = 'Progress:'
@@ -59,16 +538,49 @@ class ProgressBar:
     supply = 0
     outro = '\n'
     throttle = 0  # Do not render unless done step is more than throttle.
+    render_budget = None  # Max fraction of wall time spent rendering.
     fraction = 0
     prints = 0
+    _backlogs = ()  # Callables returning numbers of prefetched items.
+    estimated = False  # Whether total is an estimation.
+    _inferred = False  # Whether total was inferred by iter().
+    clock = None  # Callable returning the current timestamp.
+    headless = False  # Do not write to the terminal.
+    record = None  # Path where to record the rendered frames.
+    status = None  # Path of a memory-mapped file to publish the state to.
+    profile = False  # Record throughput and stalls, report them on finish.
+    profile_interval = 1  # Seconds covered by each throughput sample.
+    stall = 5  # Seconds without progress before recording a stall.
+    trace = None  # Path where to dump a Chrome trace on finish.
+    sparkline_width = 10  # Number of rates kept for {sparkline}.
+    sparkline_interval = 1  # Seconds covered by each {sparkline} rate.
+    MEASURED_FIELDS = {'sparkline', 'p50_latency', 'p99_latency'}
+    _measured = False
+    _measured_template = None
+    _measured_animation = None
 
     def __init__(self, **kwargs):
         self.columns = self.compute_columns()
         self.__dict__.update(kwargs)
+        self.estimated = Flag(self.estimated)
         if not self.template.startswith('\r'):
             self.template = '\r' + self.template
         self.formatter = Formatter()
         self._last_render = 0
+        self._render_cost = None
+        self._next_render = 0
+        self._last_update = None
+        self._last_done = 0
+        self._p50 = Quantile(0.5)
+        self._p99 = Quantile(0.99)
+        self.history = RateHistory(size=self.sparkline_width,
+                                   interval=self.sparkline_interval)
+        self.recorder = Recorder(self.record) if self.record else None
+        self.publisher = StatusFile(self.status) if self.status else None
+        self.profiler = None
+        if self.profile:
+            self.profiler = Profiler(interval=self.profile_interval,
+                                     stall=self.stall)
         if self.throttle:
             if not isinstance(self.throttle, (int, float, datetime.timedelta)):
                 raise ValueError('Invalid type for throttle: '
@@ -76,6 +588,22 @@ class ProgressBar:
             if isinstance(self.throttle, float) and self.throttle > 1.0:
                 raise ValueError('Float throttle must be between 0 and 1.0. '
                                  'Got {} instead.'.format(self.throttle))
+        if self.render_budget is not None:
+            if not 0 < self.render_budget < 1:
+                raise ValueError('Render budget must be between 0 and 1.0. '
+                                 'Got {} instead.'.format(self.render_budget))
+
+    def now(self):
+        return self.clock() if self.clock else time.time()
+
+    def timer(self):
+        # Measure durations on the same clock as the scheduling, for
+        # replays to be deterministic.
+        return self.clock() if self.clock else time.perf_counter()
+
+    def write(self, text):
+        if not self.headless:
+            sys.stdout.write(text)
 
     def format(self, tpl, *args, **kwargs):
         return self.formatter.vformat(tpl, None, self)
@@ -115,15 +643,78 @@ class ProgressBar:
     def eta(self):
         """Estimated time of arrival."""
         remaining_time = datetime.timedelta(seconds=self.tta)
-        return ETA(datetime.datetime.now() + remaining_time)
+        if self.clock:
+            now = datetime.datetime.fromtimestamp(self.clock())
+        else:
+            now = datetime.datetime.now()
+        eta = ETA(now + remaining_time)
+        eta.reference = now
+        return eta
 
     @property
     def speed(self):
         """Number of iterations per second."""
         return Float(1.0 / self.avg if self.avg else 0)
 
+    @property
+    def queued(self):
+        """Number of items prefetched but not yet consumed."""
+        return sum(backlog() for backlog in self._backlogs)
+
+    @property
+    def sparkline(self):
+        """Recent rates rendered as unicode blocks."""
+        return self.history.render()
+
+    @property
+    def p50_latency(self):
+        """Median time spent per iteration."""
+        return Duration(self._p50.value)
+
+    @property
+    def p99_latency(self):
+        """99th percentile of the time spent per iteration."""
+        return Duration(self._p99.value)
+
+    @property
+    def measured(self):
+        """Whether the template renders the measured fields."""
+        # Only pay for the measures when the template renders them, checking
+        # again each time the template or the animation is changed.
+        if (self.template is not self._measured_template
+           or self.animation is not self._measured_animation):
+            self._measured_template = self.template
+            self._measured_animation = self.animation
+            fields = {name for tpl in (self.template, self.animation)
+                      for _, name, _, _ in self.formatter.parse(tpl) if name}
+            self._measured = bool(fields & self.MEASURED_FIELDS)
+        return self._measured
+
+    def measure(self):
+        now = self.now()
+        delta = self.done - self._last_done
+        if self._last_update is not None and delta > 0:
+            latency = (now - self._last_update) / delta
+            self._p50.add(latency)
+            self._p99.add(latency)
+        self._last_update = now
+        self._last_done = self.done
+        self.history.add(now, self.done)
+
+    def publish(self):
+        now = self.now()
+        if self.start is None:
+            # Throttled renders did not start the bar yet.
+            self.start = now
+        elapsed = now - self.start
+        rate = (self.done - self.supply) / elapsed if elapsed > 0 else 0
+        self.publisher.publish(self.done, self.total, self.start, now, rate)
+
     @property
     def throttled(self):
+        if self.render_budget:
+            return ((not self.total or self.done < self.total)
+                    and self.now() < self._next_render)
         if not self.throttle:
             return False
         if isinstance(self.throttle, (int, float)):
@@ -138,21 +729,22 @@ class ProgressBar:
             self._last_render = self.done
         elif isinstance(self.throttle, datetime.timedelta):
             if ((not self.total or self.done < self.total) and
-               self._last_render + self.throttle.seconds > time.time()):
+               self._last_render + self.throttle.seconds > self.now()):
                 return True
-            self._last_render = time.time()
+            self._last_render = self.now()
         return False
 
     def render(self):
         if self.throttled:
             return
+        render_start = self.timer()
         if self.start is None:
-            self.start = time.time()
+            self.start = self.now()
         self.free_space = 0
         self.remaining = self.total - self.done
         self.addition = self.done - self.supply
         self.fraction = min(self.done / self.total, 1.0) if self.total else 0
-        self.elapsed = Timedelta(time.time() - self.start)
+        self.elapsed = Timedelta(self.now() - self.start)
         self.avg = Float(self.elapsed / self.addition if self.addition else 0)
         self.tta = Timedelta(self.remaining * self.avg)
 
@@ -160,21 +752,55 @@ class ProgressBar:
 
         self.free_space = (self.columns - len(line) + len(self.animation)
                            + self.invisible_chars)
-        sys.stdout.write(self.format(line))
+        self.frame = self.format(line)
+        self.write(self.frame)
         self.prints += 1
+        if self.recorder:
+            self.recorder.add(self.now(), self.done, self.total, self.frame)
 
-        if self.fraction >= 1.0:
+        if self.fraction >= 1.0 and not self.estimated:
             self.finish()
-        else:
+        elif not self.headless:
             sys.stdout.flush()
+        if self.render_budget:
+            # Terminal I/O is usually the most expensive part, count it.
+            self.adapt(self.timer() - render_start)
+
+    def adapt(self, cost):
+        # Smooth the measured cost, then wait long enough for the rendering
+        # to only take render_budget of the wall time.
+        if self._render_cost is None:
+            self._render_cost = cost
+        else:
+            self._render_cost += (cost - self._render_cost) * 0.3
+        self._next_render = self.now() + (
+            self._render_cost * (1 - self.render_budget) / self.render_budget)
 
     def finish(self):
-        if not self.total and self.throttle:
+        if not self.total and (self.throttle or self.render_budget):
             # In "no total" mode, we cannot know that we are doing the last
             # iteration to force rendering, so let's force render on finish.
             self.throttle = False
+            self.render_budget = None
             self.render()
-        sys.stdout.write(self.format(self.outro))
+        self.write(self.format(self.outro))
+        if self.publisher:
+            self.publish()
+            self.publisher.close()
+            self.publisher = None
+        if self.recorder:
+            self.recorder.close()
+            self.recorder = None
+        if self.profiler and not self.profiler.stopped:
+            self.profiler.stop()
+            sys.stderr.write(self.profiler.report())
+            if self.trace:
+                self.profiler.dump(self.trace)
+
+    def __del__(self):
+        profiler = getattr(self, 'profiler', None)
+        if profiler:
+            profiler.stop()
 
     def __call__(self, **kwargs):
         self.update(**kwargs)
@@ -188,18 +814,171 @@ class ProgressBar:
             # First call to update and forcing a done value. May be
             # resuming a download. Keep track for better ETA computation.
             self.supply = self.done
+        if self.measured:
+            self.measure()
+        if self.profiler:
+            self.profiler.tick(self.done)
         self.render()
+        if self.publisher:
+            self.publish()
 
     def __next__(self):
         self.update()
 
-    def iter(self, iterable):
-        for i in iterable:
-            yield i
-            self.update()
-        if self.fraction != 1.0:
-            # Spinner without total.
-            self.finish()
+    def iter(self, iterable, prefetch=0, workers=1, func=None):
+        """Iterate over iterable, updating the bar on each consumed item.
+
+        With `prefetch`, up to that many items are read in advance from a
+        background thread. With `func`, items are mapped through it by a
+        pool of `workers` threads, keeping at most `workers` of them in
+        flight, and results are yielded in order.
+
+        Without total, it is taken from the length of iterable if any, else
+        estimated and refined along the iteration, from its length hint or,
+        for files, from the bytes consumed compared to the file size.
+        """
+        if func is None and workers > 1:
+            raise ValueError('workers requires a func to map items with.')
+        estimate = None
+        base = self.done
+        if not self.total or self._inferred:
+            # Do not keep the total inferred by a previous iteration.
+            self.total = 0
+            self._inferred = False
+            estimate = self._estimator(iterable, base)
+        if prefetch:
+            iterable = self._prefetch(iterable, prefetch)
+        if func is not None:
+            iterable = self._map(iterable, func, workers, workers)
+        return self._iter(iterable, estimate, base)
+
+    def _iter(self, iterable, estimate, base):
+        if self.profiler and self.profiler.watchdog is None:
+            # Watch from now on, to catch a slow first item.
+            self.profiler.start(self.done)
+        checkpoint = 1
+        try:
+            for i in iterable:
+                yield i
+                self.update()
+                if estimate is not None and (self.done >= checkpoint
+                                             or self.done >= self.total):
+                    # Refine often at first, then every 1024 items.
+                    checkpoint = min(checkpoint * 2, checkpoint + 1024)
+                    self.total = max(base + (estimate() or 0),
+                                     self.done + 1)
+                    self.estimated = Flag(True)
+            if estimate is not None:
+                self.total = self.done
+                self._inferred = True
+                self.estimated = Flag(False)
+                self.render()
+            if self.fraction != 1.0:
+                # Spinner without total.
+                self.finish()
+        finally:
+            # Do not leave the watchdog running on break or error.
+            if self.profiler:
+                self.profiler.stop()
+
+    def _estimator(self, iterable, base):
+        # Estimations are a number of items for this iteration, which
+        # started at base.
+        if hasattr(iterable, '__len__'):
+            self.total = base + len(iterable)
+            self._inferred = True
+            return None
+        # Prefetched items are already read from the source, but not yet
+        # counted as done.
+        if operator.length_hint(iterable, 0):
+            return lambda: (self.done - base + self.queued
+                            + operator.length_hint(iterable, 0))
+        source = getattr(iterable, 'buffer', iterable)
+        if isinstance(source, gzip.GzipFile):
+            # Compare the compressed bytes consumed to the file size.
+            source = source.fileobj
+        if not isinstance(source, (io.BufferedReader, io.FileIO)):
+            # tell() must be a position in the file bytes.
+            return None
+        try:
+            info = os.fstat(source.fileno())
+            tell = source.tell
+            start = tell()
+        except (OSError, ValueError):
+            return None
+        if not stat.S_ISREG(info.st_mode) or info.st_size <= start:
+            return None
+
+        def estimate():
+            # Text files read ahead, so this is only an approximation.
+            for _ in range(10):
+                # A prefetching thread may read from the file meanwhile,
+                # retry until the position matches the queued items.
+                queued = self.queued
+                consumed = tell() - start
+                if self.queued == queued:
+                    break
+            if consumed > 0:
+                read = self.done - base + queued
+                return int(read * (info.st_size - start) / consumed)
+        return estimate
+
+    def _prefetch(self, iterable, size):
+        items = queue.Queue(maxsize=size)
+        stop = threading.Event()
+        end = object()
+
+        def put(entry):
+            while not stop.is_set():
+                try:
+                    items.put(entry, timeout=0.1)
+                except queue.Full:
+                    continue
+                return True
+            return False
+
+        def fill():
+            try:
+                for item in iterable:
+                    if not put((item, None)):
+                        return
+            except BaseException as exc:
+                put((end, exc))
+            else:
+                put((end, None))
+
+        filler = threading.Thread(target=fill, daemon=True)
+        filler.start()
+        self._backlogs += (items.qsize,)
+        try:
+            while True:
+                item, exc = items.get()
+                if item is end:
+                    if exc is not None:
+                        raise exc
+                    return
+                yield item
+        finally:
+            stop.set()
+            self._backlogs = tuple(backlog for backlog in self._backlogs
+                                   if backlog != items.qsize)
+
+    def _map(self, iterable, func, workers, size):
+        pending = collections.deque()
+        self._backlogs += (pending.__len__,)
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            try:
+                for item in iterable:
+                    pending.append(executor.submit(func, item))
+                    if len(pending) >= size:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                self._backlogs = tuple(backlog for backlog in self._backlogs
+                                       if backlog != pending.__len__)
+                for future in pending:
+                    future.cancel()
 
     def on_urlretrieve(self, blocknum, bs, size):
         """Callback to use with urllib.request.urlretrieve"""
@@ -212,6 +991,143 @@ class ProgressBar:
         self.update(done=done, total=total)
 
 
+MAX_REDIRECTS = 10
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+
+class RangesIgnored(http.client.HTTPException):
+    """A server answered a Range request with the whole content."""
+
+
+def download(url, path, bar=None, segments=4, chunk_size=None,
+             block_size=64 * 1024):
+    """Download url to path, updating bar with the bytes received.
+
+    When the server supports HTTP Range requests, the file is fetched in
+    chunks (by default one per segment) by `segments` threads, each one
+    reusing its own connection, and written in place in the preallocated
+    file. Otherwise, it is fetched as a single stream. Redirects are
+    followed.
+    """
+    if bar is None:
+        bar = ProgressBar(template='Download |{animation}| {done:B}/{total:B}')
+    local = threading.local()
+    connections = []
+    lock = threading.Lock()
+
+    def connect(parsed):
+        if not hasattr(local, 'connections'):
+            local.connections = {}
+        key = (parsed.scheme, parsed.netloc)
+        if key not in local.connections:
+            if parsed.scheme == 'https':
+                connection = http.client.HTTPSConnection(parsed.netloc)
+            else:
+                connection = http.client.HTTPConnection(parsed.netloc)
+            local.connections[key] = connection
+            connections.append(connection)
+        return local.connections[key]
+
+    def request(method, headers=None, expected=200):
+        # Follow redirects, and keep the final url for the next requests.
+        nonlocal url
+        for _ in range(MAX_REDIRECTS + 1):
+            parsed = urllib.parse.urlsplit(url)
+            target = parsed.path or '/'
+            if parsed.query:
+                target += '?' + parsed.query
+            connection = connect(parsed)
+            connection.request(method, target, headers=headers or {})
+            response = connection.getresponse()
+            if response.status == expected:
+                return response
+            location = response.getheader('Location')
+            if response.status in REDIRECT_STATUSES and location:
+                response.read()
+                url = urllib.parse.urljoin(url, location)
+                continue
+            # Do not download an unwanted body, the connection will be
+            # opened again by the next request.
+            response.close()
+            connection.close()
+            if expected == 206 and response.status == 200:
+                raise RangesIgnored(url)
+            raise http.client.HTTPException(
+                'Unexpected status for {}: {}'.format(url, response.status))
+        raise http.client.HTTPException('Too many redirects: {}'.format(url))
+
+    def fetch(start):
+        end = min(start + chunk_size, size)
+        response = request('GET', {'Range': 'bytes={}-{}'.format(
+            start, end - 1)}, expected=206)
+        offset = start
+        while True:
+            data = response.read(block_size)
+            if not data:
+                break
+            os.pwrite(fd, data, offset)
+            offset += len(data)
+            with lock:
+                bar.update(step=len(data))
+        if offset != end:
+            raise http.client.IncompleteRead(b'', end - offset)
+
+    def stream():
+        response = request('GET')
+        size = int(response.getheader('Content-Length') or 0)
+        bar.total = size
+        received = 0
+        with open(path, 'wb') as f:
+            while True:
+                data = response.read(block_size)
+                if not data:
+                    break
+                f.write(data)
+                received += len(data)
+                bar.update(step=len(data))
+        if size and received != size:
+            raise http.client.IncompleteRead(b'', size - received)
+        if not size:
+            bar.finish()
+
+    done = bar.done
+    try:
+        try:
+            response = request('HEAD')
+        except http.client.HTTPException:
+            # Some servers reject HEAD requests, go with a plain GET.
+            size = 0
+            ranges = False
+        else:
+            response.read()
+            size = int(response.getheader('Content-Length') or 0)
+            ranges = response.getheader('Accept-Ranges') == 'bytes'
+        # Writing segments in place needs os.pwrite, missing on Windows.
+        if not size or not ranges or not hasattr(os, 'pwrite'):
+            stream()
+            return
+        bar.total = size
+        chunk_size = chunk_size or -(-size // segments)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            os.ftruncate(fd, size)
+            with concurrent.futures.ThreadPoolExecutor(segments) as executor:
+                # Consume results to raise any error.
+                list(executor.map(fetch, range(0, size, chunk_size)))
+        except RangesIgnored:
+            # Advertised but not honoured, start over with a single stream.
+            os.close(fd)
+            fd = None
+            bar.done = done
+            stream()
+        finally:
+            if fd is not None:
+                os.close(fd)
+    finally:
+        for connection in connections:
+            connection.close()
+
+
 # Manage sane default formats while keeping the original type to allow any
 # built-in formatting syntax.
 
@@ -231,8 +1147,17 @@ class Percent(float):
         return super().__format__(format_spec)
 
 
+class Flag(int):
+    """A boolean formatted by default as a mark, or as the given spec."""
+
+    def __format__(self, format_spec):
+        return (format_spec or '~') if self else ''
+
+
 class ETA(datetime.datetime):
 
+    reference = None  # The "now" the ETA was computed from.
+
     def __new__(cls, *args, **kwargs):
         if args and not isinstance(args[0], int):
             # datetime + timedelta returns a datetime, while we want an ETA.
@@ -245,7 +1170,7 @@ class ETA(datetime.datetime):
 
     def __format__(self, format_spec):
         if not format_spec:
-            now = datetime.datetime.now()
+            now = self.reference or datetime.datetime.now()
             diff = self - now
             format_spec = '%H:%M:%S'
             if diff.days > 0:
@@ -253,6 +1178,18 @@ class ETA(datetime.datetime):
         return super().__format__(format_spec)
 
 
+class Duration(float):
+    """A number of seconds, formatted by default with a readable unit."""
+
+    def __format__(self, format_spec):
+        if format_spec:
+            return super().__format__(format_spec)
+        for factor, unit in ((1, 's'), (1e3, 'ms'), (1e6, 'µs')):
+            if round(self * factor, 2) >= 1:
+                return '{:.2f}{}'.format(self * factor, unit)
+        return '{:.2f}ns'.format(self * 1e9)
+
+
 class Timedelta(int):
     """An integer that is formatted by default as timedelta."""
 
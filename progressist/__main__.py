@@ -0,0 +1,56 @@
+import argparse
+import sys
+import time
+
+from progressist import read_status, replay
+
+
+def cmd_replay(args):
+    kwargs = {}
+    if args.template:
+        kwargs['template'] = args.template
+    if args.columns:
+        kwargs['columns'] = args.columns
+    if args.bench:
+        start = time.perf_counter()
+        count = sum(1 for line in replay(args.log, **kwargs))
+        duration = time.perf_counter() - start
+        per_frame = duration / count * 1e6 if count else 0
+        print('{} frames in {:.3f}s ({:.2f}µs per frame)'.format(
+            count, duration, per_frame))
+        return
+    for line in replay(args.log, **kwargs):
+        print(line.lstrip('\r'))
+
+
+def cmd_status(args):
+    status = read_status(args.path)
+    percent = status.done / status.total if status.total else 0
+    print('{:.0f}/{:.0f} {:.2%} {:.2f}/s (updated {:.1f}s ago)'.format(
+        status.done, status.total, percent, status.rate,
+        time.time() - status.updated))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='progressist')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    parser_replay = subparsers.add_parser(
+        'replay', help='Render again the frames of a recorded log.')
+    parser_replay.add_argument('log', help='Path of the recorded log.')
+    parser_replay.add_argument('--template', help='Template to render with.')
+    parser_replay.add_argument('--columns', type=int,
+                               help='Width of the rendered lines.')
+    parser_replay.add_argument('--bench', action='store_true',
+                               help='Only time the rendering.')
+    parser_replay.set_defaults(func=cmd_replay)
+    parser_status = subparsers.add_parser(
+        'status', help='Print the state published by a bar in a status file.')
+    parser_status.add_argument('path', help='Path of the status file.')
+    parser_status.set_defaults(func=cmd_status)
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,25 @@
-import time
 import datetime
+import gc
+import gzip
+import http.client
+import http.server
+import io
+import itertools
+import json
+import os
+import random
+import re
+import socketserver
+import sys
+import threading
+import time
 
 import pytest
 
-from progressist import ProgressBar
+from progressist import (Duration, Flag, Formatter, Pipeline, Profiler,
+                         ProgressBar, Quantile, Recorder, StatusFile, download,
+                         read_frames, read_status, replay)
+from progressist.__main__ import main
 
 
 @pytest.mark.parametrize('input,expected', [
@@ -13,7 +29,6 @@ from progressist import ProgressBar
     (109830983809823, '99.9 TiB'),
 ])
 def test_format_bytes(input, expected):
-    from progressist import Formatter
     fmt = Formatter()
     assert fmt.format('{:B}', input) == expected
 
@@ -25,7 +40,6 @@ def test_format_bytes(input, expected):
     ('notcastable', 'notcastable'),
 ])
 def test_format_int(input, expected):
-    from progressist import Formatter
     fmt = Formatter()
     assert fmt.format('{:D}', input) == expected
 
@@ -407,3 +421,900 @@ def test_on_urlretrieve(bar, capsys, monkeypatch):
     bar.on_urlretrieve(9, 8192, 70486)
     out, err = capsys.readouterr()
     assert out == "\rBar: ================================= 70486/70486\n"
+
+
+def test_profile_records_throughput(capsys, tmpdir):
+    path = str(tmpdir.join('trace.json'))
+    bar = ProgressBar(total=10, columns=50, template='{done}', profile=True,
+                      profile_interval=0.01, trace=path)
+    for i in bar.iter(range(10)):
+        time.sleep(0.005)
+    out, err = capsys.readouterr()
+    assert err.startswith('Throughput: ')
+    assert 'Stalls: 0' in err
+    assert bar.profiler.count > 0
+    assert all(rate > 0 for _, rate in bar.profiler.samples)
+    with open(path) as f:
+        events = json.load(f)['traceEvents']
+    assert events
+    assert all(e['name'] == 'throughput' and e['ph'] == 'C' for e in events)
+
+
+def test_profile_records_stall_before_first_item(capsys):
+
+    def slow_source():
+        time.sleep(0.2)
+        yield 1
+
+    bar = ProgressBar(total=1, template='{done}', profile=True, stall=0.05)
+    assert list(bar.iter(slow_source())) == [1]
+    assert len(bar.profiler.stalls) == 1
+    assert bar.profiler.stalls[0]['done'] == 0
+    assert 'slow_source' in ''.join(bar.profiler.stalls[0]['stack'])
+
+
+def test_profile_stops_watchdog_on_break():
+    before = threading.active_count()
+    bar = ProgressBar(total=10, headless=True, profile=True, stall=0.05)
+    for i in bar.iter(range(10)):
+        if i == 3:
+            break
+    time.sleep(0.3)
+    assert threading.active_count() == before
+    assert bar.profiler.stalls == []
+
+
+def test_profile_stops_watchdog_on_error():
+    before = threading.active_count()
+    bar = ProgressBar(total=10, headless=True, profile=True, stall=0.05)
+    with pytest.raises(RuntimeError):
+        for i in bar.iter(range(10)):
+            raise RuntimeError('oops')
+    assert threading.active_count() == before
+
+
+def test_profile_stops_watchdog_when_bar_is_collected():
+    before = threading.active_count()
+    bar = ProgressBar(total=10, headless=True, profile=True)
+    bar.update()
+    assert threading.active_count() == before + 1
+    del bar
+    gc.collect()
+    assert threading.active_count() == before
+
+
+def test_profile_ring_buffer_keeps_last_samples():
+    profiler = Profiler(size=3)
+    for i in range(5):
+        profiler.bucket_start = i
+        profiler.bucket_done = 0
+        profiler.done = i
+        profiler.push(i + 1)
+    assert [stamp for stamp, _ in profiler.samples] == [2, 3, 4]
+    assert [rate for _, rate in profiler.samples] == [2, 3, 4]
+
+
+def test_profile_records_stalls_with_stack(capsys):
+    bar = ProgressBar(total=3, template='{done}', profile=True, stall=0.05)
+
+    def slow_stage():
+        time.sleep(0.2)
+
+    bar.update()
+    slow_stage()
+    bar.update()
+    bar.update()
+    out, err = capsys.readouterr()
+    assert len(bar.profiler.stalls) == 1
+    stall = bar.profiler.stalls[0]
+    assert stall['done'] == 1
+    assert stall['end'] - stall['start'] >= 0.2
+    assert 'slow_stage' in ''.join(stall['stack'])
+    assert 'Stalls: 1' in err
+    assert 'slow_stage' in err
+
+
+@pytest.mark.parametrize('p', [0.5, 0.9, 0.99])
+def test_quantile_estimation(p):
+    rand = random.Random(42)
+    values = [rand.expovariate(1) for i in range(20000)]
+    quantile = Quantile(p)
+    for value in values:
+        quantile.add(value)
+    expected = sorted(values)[int(p * len(values))]
+    assert quantile.value == pytest.approx(expected, rel=0.05)
+    assert len(quantile.heights) == 5
+
+
+def test_quantile_with_few_values():
+    quantile = Quantile(0.5)
+    assert quantile.value == 0
+    for value in (3, 1, 2):
+        quantile.add(value)
+    assert quantile.value == 2
+
+
+def test_sparkline(capsys, monkeypatch):
+    now = [1000]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    bar = ProgressBar(total=100, template='{sparkline}', sparkline_width=4)
+    for step in (0, 1, 2, 4, 8, 4):
+        bar.update(step)
+        now[0] += 1
+    out, err = capsys.readouterr()
+    assert out.endswith('\r▂▄█▄')
+
+
+def test_latency_percentiles(capsys, monkeypatch):
+    now = [1000]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    bar = ProgressBar(template='{p50_latency}')
+    bar.update()
+    for i in range(2000):
+        # One slow iteration out of fifty.
+        now[0] += 0.1 if i % 50 == 49 else 0.001
+        bar.update()
+    out, err = capsys.readouterr()
+    assert out.endswith('1.00ms')
+    assert bar.p50_latency == pytest.approx(0.001, rel=0.01)
+    assert bar.p99_latency == pytest.approx(0.1, rel=0.01)
+
+
+@pytest.mark.parametrize('template,animation,expected', [
+    ('{done}', '{progress}', False),
+    ('{prefix} {animation}', '{progress}', False),
+    ('{done} {sparkline}', '{progress}', True),
+    ('{done} {p50_latency:.3f}', '{progress}', True),
+    ('{prefix} {animation}', '{p99_latency}', True),
+])
+def test_measure_only_when_template_needs_it(template, animation, expected):
+    bar = ProgressBar(template=template, animation=animation, headless=True)
+    assert bar.measured is expected
+    bar.update()
+    bar.update()
+    assert (bar.history.bucket_start is not None) is expected
+
+
+def test_measure_when_template_is_changed(capsys, monkeypatch):
+    now = [1000]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    bar = ProgressBar(template='{done}')
+    assert not bar.measured
+    bar.template = '{sparkline} {p50_latency}'
+    assert bar.measured
+    bar.update()
+    now[0] += 1
+    bar.update()
+    out, err = capsys.readouterr()
+    assert out.endswith('█ 1.00s')
+    bar.template = '{done}'
+    assert not bar.measured
+    bar.update(template='{p50_latency}')
+    assert bar.measured
+    now[0] += 0.5
+    bar.update()
+    out, err = capsys.readouterr()
+    assert out.endswith('500.00ms')
+    assert bar._p50.heights == [0, 0.5, 1]
+
+
+@pytest.mark.parametrize('input,expected', [
+    (2.5, '2.50s'),
+    (0.0123, '12.30ms'),
+    (0.000004, '4.00µs'),
+    (0.0000000012, '1.20ns'),
+])
+def test_duration_format(input, expected):
+    assert '{}'.format(Duration(input)) == expected
+    assert '{:.1f}'.format(Duration(input)) == '{:.1f}'.format(input)
+
+
+def test_render_budget(bar, capsys, monkeypatch):
+    now = [1000]
+    counter = [0]
+
+    def fake_perf_counter():
+        # Each rendering costs 10ms.
+        counter[0] += 0.01
+        return counter[0]
+
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    monkeypatch.setattr(time, 'perf_counter', fake_perf_counter)
+    bar.total = 0
+    bar.render_budget = 0.01
+    bar.template = '{done}'
+    bar.update()
+    out, err = capsys.readouterr()
+    assert out == '1'
+    assert bar._render_cost == pytest.approx(0.01)
+    # 10ms for 1% of the time: no render before 990ms.
+    now[0] += 0.9
+    bar.update()
+    out, err = capsys.readouterr()
+    assert out == ''
+    now[0] += 0.1
+    bar.update()
+    out, err = capsys.readouterr()
+    assert out == '3'
+    bar.update()
+    out, err = capsys.readouterr()
+    assert out == ''
+    # Finish should force render.
+    bar.finish()
+    out, err = capsys.readouterr()
+    assert out == '4\n'
+
+
+def test_render_budget_counts_terminal_io(monkeypatch):
+    now = [1000]
+    counter = [0]
+
+    class SlowTerminal:
+
+        def write(self, text):
+            pass
+
+        def flush(self):
+            counter[0] += 0.01
+
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    monkeypatch.setattr(time, 'perf_counter', lambda: counter[0])
+    monkeypatch.setattr(sys, 'stdout', SlowTerminal())
+    bar = ProgressBar(render_budget=0.01, template='{done}')
+    bar.update()
+    assert bar._render_cost == pytest.approx(0.01)
+    assert bar._next_render == pytest.approx(1000.99)
+
+
+def test_render_budget_with_clock(monkeypatch):
+    now = [1000]
+
+    class SlowTerminal:
+
+        def write(self, text):
+            pass
+
+        def flush(self):
+            now[0] += 0.01
+
+    def fail():
+        raise AssertionError('Should use the bar clock.')
+
+    monkeypatch.setattr(time, 'perf_counter', fail)
+    monkeypatch.setattr(sys, 'stdout', SlowTerminal())
+    bar = ProgressBar(render_budget=0.01, template='{done}',
+                      clock=lambda: now[0])
+    bar.update()
+    assert bar._render_cost == pytest.approx(0.01)
+    assert bar._next_render == pytest.approx(1001)
+    now[0] += 0.9
+    bar.update()
+    assert bar.prints == 1
+    now[0] += 0.1
+    bar.update()
+    assert bar.prints == 2
+
+
+def test_render_budget_always_renders_last_step(bar, capsys):
+    bar.render_budget = 0.000001
+    bar.update(done=50)
+    out, err = capsys.readouterr()
+    assert out == '\rBar: ===================                    50/100'
+    bar.update(done=51)
+    out, err = capsys.readouterr()
+    assert out == ''
+    bar.update(done=100)
+    out, err = capsys.readouterr()
+    assert out == '\rBar: ===================================== 100/100\n'
+
+
+@pytest.mark.parametrize('budget', [0, 1, 1.5])
+def test_should_raise_if_render_budget_is_invalid(budget):
+    with pytest.raises(ValueError):
+        ProgressBar(render_budget=budget)
+
+
+def test_pipeline(capsys):
+    def slow(items, delay):
+        for item in items:
+            time.sleep(delay)
+            yield item
+
+    pipeline = Pipeline()
+    read = pipeline.stage('read', slow(range(20), 0.001), sample=1)
+    evens = pipeline.stage('filter', (i for i in read if not i % 2),
+                           sample=1)
+    pipeline.stage('transform', slow(evens, 0.01), sample=1)
+    bar = ProgressBar(total=10, template='{pipeline}', pipeline=pipeline)
+    assert list(bar.iter(pipeline.stages[-1])) == list(range(0, 20, 2))
+    assert pipeline.bottleneck.name == 'transform'
+    assert [(s.received, s.count) for s in pipeline.stages] == [
+        (20, 20), (20, 10), (10, 10)]
+    out, err = capsys.readouterr()
+    assert out.startswith('\rread 1→1 ')
+    last = out.split('\r')[-1]
+    assert re.match(r'read 19→19 \d+% \| filter 19→10 \d+% '
+                    r'\| \*transform 10→10 \d+%\n', last)
+
+
+def test_pipeline_stage_samples_timing():
+    pipeline = Pipeline()
+    stage = pipeline.stage('read', range(100), sample=10)
+    assert list(stage) == list(range(100))
+    assert stage.count == 100
+    assert stage.sampled == 10
+
+
+def test_pipeline_stage_counts_in_batches():
+    pipeline = Pipeline()
+    stage = pipeline.stage('read', range(100), sample=10)
+    for i in range(15):
+        next(stage)
+    assert stage.count == 11
+    for i in range(5):
+        next(stage)
+    assert stage.count == 11
+    next(stage)
+    assert stage.count == 21
+    # Partial batch is published at the end.
+    stage = pipeline.stage('read', range(25), sample=10)
+    assert list(stage) == list(range(25))
+    assert stage.count == 25
+
+
+def test_iter_prefetch_overlaps_source_and_consumer(bar, capsys):
+
+    def slow_source():
+        for i in range(10):
+            time.sleep(0.02)
+            yield i
+
+    bar.total = 10
+    start = time.perf_counter()
+    items = []
+    for i in bar.iter(slow_source(), prefetch=4):
+        time.sleep(0.02)
+        items.append(i)
+    assert items == list(range(10))
+    assert time.perf_counter() - start < 0.35
+    assert bar.done == 10
+
+
+def test_iter_prefetch_queued(bar, capsys):
+    bar.template = '\r{done} {queued}'
+    for i in bar.iter(range(100), prefetch=5):
+        if i == 50:
+            time.sleep(0.05)  # Let the filler thread fill the queue.
+    out, err = capsys.readouterr()
+    # Item 51 is taken from the full queue, the filler may refill it.
+    assert re.search('\r52 [45]', out)
+    assert bar.queued == 0
+
+
+def test_iter_prefetch_propagates_errors(bar):
+
+    def broken():
+        yield 1
+        raise RuntimeError('oops')
+
+    with pytest.raises(RuntimeError):
+        list(bar.iter(broken(), prefetch=2))
+    assert bar.done == 1
+
+
+def test_iter_prefetch_stops_filler_on_break(bar):
+    before = threading.active_count()
+    for i in bar.iter(itertools.count(), prefetch=2):
+        if i == 5:
+            break
+    time.sleep(0.3)
+    assert threading.active_count() == before
+
+
+def test_iter_map_with_workers(bar, capsys):
+
+    def slow_square(i):
+        time.sleep(0.05)
+        return i * i
+
+    bar.total = 20
+    bar.template = '{done} {queued}'
+    start = time.perf_counter()
+    results = list(bar.iter(range(20), func=slow_square, workers=10))
+    assert time.perf_counter() - start < 0.5
+    assert results == [i * i for i in range(20)]
+    assert bar.done == 20
+
+
+def test_iter_map_with_prefetch_overlaps_source(bar):
+
+    def slow_source():
+        for i in range(10):
+            time.sleep(0.02)
+            yield i
+
+    def slow_double(i):
+        time.sleep(0.02)
+        return i * 2
+
+    bar.total = 10
+    start = time.perf_counter()
+    results = list(bar.iter(slow_source(), prefetch=4, func=slow_double))
+    assert time.perf_counter() - start < 0.35
+    assert results == [i * 2 for i in range(10)]
+    assert bar.queued == 0
+    assert bar._backlogs == ()
+
+
+def test_iter_workers_requires_func(bar):
+    with pytest.raises(ValueError):
+        bar.iter(range(10), workers=2)
+
+
+def test_record_headless_with_clock(capsys, tmpdir):
+    path = str(tmpdir.join('frames.log'))
+    now = [1000]
+    bar = ProgressBar(total=4, columns=30, headless=True,
+                      clock=lambda: now[0], record=path,
+                      template='{done}/{total} {elapsed}')
+    for i in bar.iter(range(4)):
+        now[0] += i + 0.5
+    out, err = capsys.readouterr()
+    assert out == ''
+    frames = list(read_frames(path))
+    assert [(f.done, f.total) for f in frames] == [(1, 4), (2, 4), (3, 4),
+                                                  (4, 4)]
+    assert [f.line for f in frames] == ['\r1/4 0:00:00', '\r2/4 0:00:01',
+                                        '\r3/4 0:00:04', '\r4/4 0:00:07']
+    assert all(a.timestamp < b.timestamp for a, b in zip(frames, frames[1:]))
+
+
+def test_replay(tmpdir):
+    path = str(tmpdir.join('frames.log'))
+    recorder = Recorder(path)
+    for done in (0, 25, 50, 100):
+        recorder.add(1000 + done, done, 100, 'whatever')
+    recorder.close()
+    lines = list(replay(path, columns=30, template='{animation} {elapsed}'))
+    assert lines == [
+        '\r                       0:00:00',
+        '\r=====                  0:00:25',
+        '\r===========            0:00:50',
+        '\r====================== 0:01:40',
+    ]
+
+
+def test_replay_measures_frames(tmpdir):
+    path = str(tmpdir.join('frames.log'))
+    recorder = Recorder(path)
+    for second, done in enumerate((0, 10, 30, 40, 80)):
+        recorder.add(1000 + second, done, 100, '')
+    recorder.close()
+    lines = list(replay(path, template='{sparkline}|{p50_latency}'))
+    assert lines == ['\r|0.00ns', '\r█|100.00ms', '\r▄█|50.00ms',
+                     '\r▄█▄|100.00ms', '\r▂▄▂█|100.00ms']
+
+
+def test_replay_skips_throttled_frames(tmpdir):
+    path = str(tmpdir.join('frames.log'))
+    recorder = Recorder(path)
+    for done in range(0, 101, 2):
+        recorder.add(1000 + done, done, 100, '')
+    recorder.close()
+    lines = list(replay(path, throttle=10, template='{done}'))
+    assert lines == ['\r{}'.format(done) for done in range(10, 101, 10)]
+
+
+def test_replay_eta_follows_recorded_clock(tmpdir):
+    path = str(tmpdir.join('frames.log'))
+    recorder = Recorder(path)
+    day = 60 * 60 * 24
+    recorder.add(1000, 0, 100, '')
+    recorder.add(1000 + 2 * day, 50, 100, '')
+    recorder.close()
+    lines = list(replay(path, template='{eta}'))
+    eta = datetime.datetime.fromtimestamp(1000 + 4 * day)
+    assert lines[-1] == eta.strftime('\r%Y-%m-%d %H:%M:%S')
+
+
+def test_read_frames_should_raise_on_invalid_log(tmpdir):
+    path = tmpdir.join('frames.log')
+    path.write('not a log')
+    with pytest.raises(ValueError):
+        list(read_frames(str(path)))
+
+
+def test_replay_command(tmpdir, capsys):
+    path = str(tmpdir.join('frames.log'))
+    recorder = Recorder(path)
+    recorder.add(1000, 1, 2, '')
+    recorder.add(1001, 2, 2, '')
+    recorder.close()
+    main(['replay', path, '--template', '{done}/{total}'])
+    out, err = capsys.readouterr()
+    assert out == '1/2\n2/2\n'
+    main(['replay', path, '--bench'])
+    out, err = capsys.readouterr()
+    assert out.startswith('2 frames in ')
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serve `data`, supporting Range requests, `delay` seconds per request."""
+
+    data = bytes(range(256)) * 4096
+    delay = 0
+    ranges = True
+    head = True
+    truncate = False
+    ignore_ranges = False
+
+    def log_message(self, *args):
+        pass
+
+    def send_headers(self, status, length):
+        self.send_response(status)
+        self.send_header('Content-Length', str(length))
+        if self.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def redirect(self):
+        # Redirect /redirect to /data, anything else is not found.
+        if self.path == '/data':
+            return False
+        if self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', '/data')
+        else:
+            self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return True
+
+    def do_HEAD(self):
+        if self.redirect():
+            return
+        if not self.head:
+            self.send_response(405)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_headers(200, len(self.data))
+
+    def do_GET(self):
+        if self.redirect():
+            return
+        time.sleep(self.delay)
+        header = self.headers.get('Range')
+        if header and self.ranges and not self.ignore_ranges:
+            start, end = header[len('bytes='):].split('-')
+            body = self.data[int(start):int(end) + 1]
+            self.send_headers(206, len(body))
+        else:
+            body = self.data
+            self.send_headers(200, len(body))
+        if self.truncate:
+            body = body[:len(body) // 2]
+            self.close_connection = True
+        self.wfile.write(body)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                          http.server.HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('segments', [1, 3, 4])
+def test_download(server, tmpdir, capsys, segments):
+    path = str(tmpdir.join('data'))
+    url = 'http://127.0.0.1:{}/data'.format(server.server_port)
+    bar = ProgressBar(template='{done}/{total}')
+    download(url, path, bar=bar, segments=segments, block_size=4096)
+    with open(path, 'rb') as f:
+        assert f.read() == RangeHandler.data
+    out, err = capsys.readouterr()
+    assert out.endswith('\r1048576/1048576\n')
+
+
+def test_download_reuses_connections_for_chunks(server, tmpdir):
+    path = str(tmpdir.join('data'))
+    url = 'http://127.0.0.1:{}/data'.format(server.server_port)
+    bar = ProgressBar(headless=True)
+    download(url, path, bar=bar, segments=2, chunk_size=100000)
+    with open(path, 'rb') as f:
+        assert f.read() == RangeHandler.data
+    assert bar.done == len(RangeHandler.data)
+
+
+def test_download_without_ranges(server, tmpdir, monkeypatch):
+    monkeypatch.setattr(RangeHandler, 'ranges', False)
+    path = str(tmpdir.join('data'))
+    url = 'http://127.0.0.1:{}/data'.format(server.server_port)
+    bar = ProgressBar(headless=True)
+    download(url, path, bar=bar, segments=4)
+    with open(path, 'rb') as f:
+        assert f.read() == RangeHandler.data
+    assert bar.done == len(RangeHandler.data)
+
+
+@pytest.mark.parametrize('segments', [1, 4])
+def test_download_follows_redirects(server, tmpdir, segments):
+    path = str(tmpdir.join('data'))
+    url = 'http://127.0.0.1:{}/redirect'.format(server.server_port)
+    bar = ProgressBar(headless=True)
+    download(url, path, bar=bar, segments=segments)
+    with open(path, 'rb') as f:
+        assert f.read() == RangeHandler.data
+    assert bar.done == bar.total == len(RangeHandler.data)
+
+
+def test_download_without_head(server, tmpdir, monkeypatch):
+    monkeypatch.setattr(RangeHandler, 'head', False)
+    path = str(tmpdir.join('data'))
+    url = 'http://127.0.0.1:{}/data'.format(server.server_port)
+    bar = ProgressBar(headless=True)
+    download(url, path, bar=bar)
+    with open(path, 'rb') as f:
+        assert f.read() == RangeHandler.data
+    assert bar.done == bar.total == len(RangeHandler.data)
+
+
+def test_download_should_raise_on_incomplete_stream(server, tmpdir,
+                                                    monkeypatch):
+    monkeypatch.setattr(RangeHandler, 'ranges', False)
+    monkeypatch.setattr(RangeHandler, 'truncate', True)
+    url = 'http://127.0.0.1:{}/data'.format(server.server_port)
+    with pytest.raises(http.client.IncompleteRead):
+        download(url, str(tmpdir.join('data')),
+                 bar=ProgressBar(headless=True))
+
+
+def test_download_should_raise_on_error_status(server, tmpdir):
+    url = 'http://127.0.0.1:{}/data'.format(server.server_port)
+    with pytest.raises(http.client.HTTPException):
+        download(url.replace('/data', '/missing'), str(tmpdir.join('data')),
+                 bar=ProgressBar(headless=True))
+
+
+def test_download_without_pwrite(server, tmpdir, monkeypatch):
+    monkeypatch.delattr(os, 'pwrite')
+    path = str(tmpdir.join('data'))
+    url = 'http://127.0.0.1:{}/data'.format(server.server_port)
+    bar = ProgressBar(headless=True)
+    download(url, path, bar=bar, segments=4)
+    with open(path, 'rb') as f:
+        assert f.read() == RangeHandler.data
+    assert bar.done == bar.total == len(RangeHandler.data)
+
+
+def test_download_when_server_ignores_ranges(server, tmpdir, monkeypatch):
+    monkeypatch.setattr(RangeHandler, 'ignore_ranges', True)
+    path = str(tmpdir.join('data'))
+    url = 'http://127.0.0.1:{}/data'.format(server.server_port)
+    bar = ProgressBar(headless=True)
+    download(url, path, bar=bar, segments=4)
+    with open(path, 'rb') as f:
+        assert f.read() == RangeHandler.data
+    assert bar.done == bar.total == len(RangeHandler.data)
+
+
+def test_download_scales_with_segments(server, tmpdir, monkeypatch):
+    monkeypatch.setattr(RangeHandler, 'delay', 0.1)
+    url = 'http://127.0.0.1:{}/data'.format(server.server_port)
+    durations = {}
+    for segments in (1, 4):
+        start = time.perf_counter()
+        download(url, str(tmpdir.join('data')), segments=segments,
+                 chunk_size=len(RangeHandler.data) // 4,
+                 bar=ProgressBar(headless=True))
+        durations[segments] = time.perf_counter() - start
+    assert durations[4] < durations[1] / 2
+
+
+def test_iter_takes_total_from_len(capsys):
+    bar = ProgressBar(template='{done}/{total}{estimated}')
+    assert list(bar.iter(['a', 'b', 'c'])) == ['a', 'b', 'c']
+    out, err = capsys.readouterr()
+    assert out == '\r1/3\r2/3\r3/3\n'
+
+
+def test_iter_twice_on_the_same_bar(capsys):
+    bar = ProgressBar(template='{done}/{total}{estimated}')
+    assert list(bar.iter([1, 2, 3])) == [1, 2, 3]
+    out, err = capsys.readouterr()
+    assert out == '\r1/3\r2/3\r3/3\n'
+    assert list(bar.iter([4, 5])) == [4, 5]
+    out, err = capsys.readouterr()
+    assert out == '\r4/5\r5/5\n'
+    assert list(bar.iter(iter([6, 7]))) == [6, 7]
+    out, err = capsys.readouterr()
+    assert out == '\r6/0\r7/7~\r7/7\n'
+    assert list(bar.iter(i for i in (8, 9))) == [8, 9]
+    out, err = capsys.readouterr()
+    assert out == '\r8/0\r9/0\n'
+
+
+def test_iter_twice_estimates_from_file_size(tmpdir):
+    path = tmpdir.join('big.log')
+    path.write('\n'.join('line {:06d}'.format(i) for i in range(10000)))
+    bar = ProgressBar(headless=True, throttle=100)
+    for i in range(2):
+        with open(str(path), 'rb') as f:
+            for j, line in enumerate(bar.iter(f)):
+                if j == 5000:
+                    assert bar.total == pytest.approx(10000 * (i + 1),
+                                                      rel=0.05)
+    assert bar.total == bar.done == 20000
+
+
+def test_iter_estimates_total_from_length_hint(capsys):
+    bar = ProgressBar(template='{done}/{total}{estimated}')
+    assert list(bar.iter(iter(['a', 'b', 'c']))) == ['a', 'b', 'c']
+    out, err = capsys.readouterr()
+    assert out == '\r1/0\r2/3~\r3/3~\r3/3\n'
+
+
+def test_iter_without_estimation(capsys):
+    bar = ProgressBar(template='{done}/{total}{estimated}')
+    assert list(bar.iter(i for i in 'abc')) == ['a', 'b', 'c']
+    out, err = capsys.readouterr()
+    assert out == '\r1/0\r2/0\r3/0\n'
+
+
+@pytest.mark.parametrize('mode', ['r', 'rb'])
+def test_iter_estimates_total_from_file_size(tmpdir, mode):
+    path = tmpdir.join('big.log')
+    path.write('\n'.join('line {:06d}'.format(i) for i in range(100000)))
+    bar = ProgressBar(headless=True, throttle=1000)
+    totals = []
+    with open(str(path), mode) as f:
+        for i, line in enumerate(bar.iter(f)):
+            if i in (10000, 50000, 90000):
+                assert bar.estimated
+                totals.append(bar.total)
+    assert all(total == pytest.approx(100000, rel=0.05) for total in totals)
+    assert bar.total == bar.done == 100000
+    assert not bar.estimated
+
+
+@pytest.mark.parametrize('mode', ['rt', 'rb'])
+def test_iter_estimates_total_from_gzip_file(tmpdir, mode):
+    path = str(tmpdir.join('big.log.gz'))
+    with gzip.open(path, 'wt') as f:
+        # Random lines, for the compression ratio to be even along the file.
+        rand = random.Random(42)
+        f.write('\n'.join('line {}'.format(rand.random())
+                          for i in range(100000)))
+    bar = ProgressBar(headless=True, throttle=1000)
+    totals = []
+    with gzip.open(path, mode) as f:
+        for i, line in enumerate(bar.iter(f)):
+            if i in (25000, 50000, 75000):
+                assert bar.estimated
+                totals.append(bar.total)
+    assert all(total == pytest.approx(100000, rel=0.1) for total in totals)
+    assert bar.total == bar.done == 100000
+
+
+def test_iter_does_not_estimate_from_unknown_file_objects():
+    bar = ProgressBar(headless=True)
+    assert list(bar.iter(io.BytesIO(b'a\nb\n'))) == [b'a\n', b'b\n']
+    assert bar.done == 2
+    assert bar.total == 0
+    assert not bar.estimated
+
+
+def test_iter_estimates_total_with_prefetch(tmpdir):
+    path = tmpdir.join('big.log')
+    path.write('\n'.join('line {:06d}'.format(i) for i in range(200000)))
+    bar = ProgressBar(headless=True, throttle=1000)
+    totals = []
+    with open(str(path), 'rb') as f:
+        for i, line in enumerate(bar.iter(f, prefetch=5000)):
+            if i in (20000, 100000):
+                time.sleep(0.05)  # Let the filler get ahead.
+            if i in (20001, 100001):
+                totals.append(bar.total)
+    assert all(total == pytest.approx(200000, rel=0.05) for total in totals)
+    assert bar.total == 200000
+
+
+def test_estimated_format():
+    assert '{}'.format(Flag(True)) == '~'
+    assert '{}'.format(Flag(False)) == ''
+    assert '{:(approx)}'.format(Flag(True)) == '(approx)'
+    assert '{:(approx)}'.format(Flag(False)) == ''
+
+
+def test_status_file(tmpdir, monkeypatch):
+    path = str(tmpdir.join('status'))
+    now = [1000]
+    bar = ProgressBar(total=10, headless=True, status=path,
+                      clock=lambda: now[0])
+    bar.update()
+    assert read_status(path) == (1, 10, 1000, 1000, 0)
+    now[0] += 2
+    bar.update(step=4)
+    assert read_status(path) == (5, 10, 1000, 1002, 2.5)
+    now[0] += 2
+    bar.update(step=5)
+    assert bar.publisher is None
+    assert read_status(path) == (10, 10, 1000, 1004, 2.5)
+
+
+def test_status_file_with_throttle(tmpdir):
+    path = str(tmpdir.join('status'))
+    now = [1000]
+    bar = ProgressBar(total=100, throttle=10, headless=True, status=path,
+                      clock=lambda: now[0])
+    bar.update()
+    now[0] += 2
+    bar.update()
+    assert bar.prints == 0
+    assert read_status(path) == (2, 100, 1000, 1002, 1)
+
+
+def test_status_file_snapshots_are_consistent(tmpdir):
+    path = str(tmpdir.join('status'))
+    status = StatusFile(path)
+    stop = threading.Event()
+
+    def write():
+        i = 0
+        while not stop.is_set():
+            i += 1
+            status.publish(i, i, i, i, i)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        for _ in range(1000):
+            snapshot = read_status(path)
+            assert len(set(snapshot)) == 1
+    finally:
+        stop.set()
+        writer.join()
+        status.close()
+
+
+def test_read_status_retries_while_writing(tmpdir):
+    path = str(tmpdir.join('status'))
+    status = StatusFile(path)
+    status.SEQ.pack_into(status.map, status.SEQ_OFFSET, 1)
+    with pytest.raises(RuntimeError):
+        read_status(path, retries=10)
+    status.close()
+
+
+def test_read_status_should_raise_on_invalid_file(tmpdir):
+    path = tmpdir.join('status')
+    path.write('x' * StatusFile.SIZE)
+    with pytest.raises(ValueError):
+        read_status(str(path))
+
+
+def test_status_command(tmpdir, capsys):
+    path = str(tmpdir.join('status'))
+    status = StatusFile(path)
+    status.publish(25, 100, time.time() - 10, time.time(), 2.5)
+    status.close()
+    main(['status', path])
+    out, err = capsys.readouterr()
+    assert out == '25/100 25.00% 2.50/s (updated 0.0s ago)\n'
+    status = StatusFile(path)
+    status.publish(12345678, 5e7, time.time() - 10, time.time(), 1234567.8)
+    status.close()
+    main(['status', path])
+    out, err = capsys.readouterr()
+    assert out == ('12345678/50000000 24.69% 1234567.80/s '
+                   '(updated 0.0s ago)\n')